@@ -1,28 +1,35 @@
 import argparse
+import io
 import logging
-import json
 import os
+import queue
 import random
+import sys
+import threading
 import time
 import unicodedata
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from functools import lru_cache
-from tempfile import TemporaryDirectory
 import xml.etree.ElementTree as ET
 
 import requests
 
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
 import numpy as np
 
 import rasterio
 
 from google.cloud import storage
 
+from PIL import Image
+
 from rasterio.windows import Window
 
-from skimage import io
 from skimage import exposure
-from skimage import transform
 
 import twitter
 
@@ -42,11 +49,56 @@ storage_client = storage.Client()
 bucket_name = "gcp-public-data-sentinel-2"
 BUCKET = storage_client.get_bucket(bucket_name)
 
+# number of tiles `search_granules` searches at the same time, each lists
+# its blobs through the storage client
+PROBES = 4
+# metadata downloads of all concurrent `pick_date` calls share this pool,
+# sized so that together with the probes' listings we stay within the
+# storage client's pool of 10 connections per host
+METADATA_POOL = ThreadPoolExecutor(10 - PROBES)
+
+# configure GDAL to read JP2s from the public bucket with range requests
+GDAL_ENV = dict(
+    CPL_VSIL_CURL_ALLOWED_EXTENSIONS=".jp2",
+    GDAL_DISABLE_READDIR_ON_OPEN="EMPTY_DIR",
+    VSI_CACHE="YES",
+    GDAL_HTTP_MERGE_CONSECUTIVE_RANGES="YES",
+    CPL_VSIL_CURL_CACHE_SIZE="64000000",
+    # fetch in large chunks, few big requests are much faster on GCS than
+    # many small ones
+    CPL_VSIL_CURL_CHUNK_SIZE="2097152",
+    # decode JP2 tiles and code-blocks on all cores
+    GDAL_NUM_THREADS="ALL_CPUS",
+)
+
+# keep connections to the same hosts alive between requests and retry
+# failed ones, including rate limited and server errors, with a backoff
+SESSION = requests.Session()
+for scheme in ("http://", "https://"):
+    SESSION.mount(
+        scheme,
+        HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=4,
+            max_retries=Retry(
+                total=5,
+                backoff_factor=0.2,
+                status_forcelist=(429, 500, 502, 503, 504),
+                respect_retry_after_header=True,
+            ),
+        ),
+    )
+
+LAST_NOMINATIM = 0.0
+
 HERE = os.path.dirname(os.path.abspath(__file__))
-VALID_MGRS = []
+# intern the strings so that the tuples hash and compare cheaply as keys
+# of the `list_band2s` cache
 with open(os.path.join(HERE, "valid_mgrs")) as f:
-    for mgrs in f:
-        VALID_MGRS.append((int(mgrs[:2]), mgrs[2:3], mgrs[3:5]))
+    VALID_MGRS = tuple(
+        (int(mgrs[:2]), sys.intern(mgrs[2:3]), sys.intern(mgrs[3:5]))
+        for mgrs in f
+    )
 
 MONTHS = [
     "Padding to make the indexing right",
@@ -74,24 +126,49 @@ def twitter_credentials():
     )
 
 
-def count_pixels(img, colour=[0.0, 0.0, 0.0]):
-    """Count pixels that are specified colour"""
-    return np.sum(
-        np.logical_and(
-            img[:, :, 0] == colour[0],
-            img[:, :, 1] == colour[1],
-            img[:, :, 2] == colour[2],
-        )
+def count_pixels(channels, colour=[0.0, 0.0, 0.0], rows=256):
+    """Count pixels that are specified colour
+
+    `channels` are the red, green and blue 16bit channels of the image as
+    separate 2D arrays. They are packed into one 64bit integer per pixel
+    so that a pixel is matched with a single comparison. The image is
+    processed `rows` rows at a time through one reused scratch buffer.
+    """
+    red, green, blue = channels
+    shift = np.uint64(16)
+    key = np.uint64(
+        (int(colour[0]) << 32) | (int(colour[1]) << 16) | int(colour[2])
     )
+    scratch = np.empty((min(rows, red.shape[0]), red.shape[1]), np.uint64)
 
+    count = 0
+    for start in range(0, red.shape[0], rows):
+        block = slice(start, start + rows)
+        packed = scratch[: red[block].shape[0]]
+        packed[...] = red[block]
+        packed <<= shift
+        packed |= green[block]
+        packed <<= shift
+        packed |= blue[block]
+        count += np.count_nonzero(packed == key)
 
-def random_mgrs(seed=657):
-    rng = random.Random(seed)
+    return count
+
+
+def random_mgrs(rng):
+    """Pick a MGRS tile using the `random.Random` instance `rng`"""
     return rng.choice(VALID_MGRS)
 
 
 def get_address(lat, lng):
     """Convert latitude and longitude into an address using OSM"""
+    # round so that lookups for (almost) the same spot hit the cache
+    return reverse_geocode(round(lat, 4), round(lng, 4))
+
+
+@lru_cache(maxsize=1024)
+def reverse_geocode(lat, lng):
+    global LAST_NOMINATIM
 
     def _norm_len(s):
         return len(unicodedata.normalize("NFC", s).encode("utf-8"))
@@ -99,21 +176,33 @@ def get_address(lat, lng):
     def _cut(s, max_len=72):
         if _norm_len(s) < max_len:
             return s
-        while _norm_len(s) >= max_len:
-            ss = s.split(",")
-            s = ", ".join([x.strip() for x in ss[1:]])
-        return s
+        # drop leading parts until the rest is short enough, keeping track
+        # of the length of ", ".join(parts[i:]) instead of re-measuring it
+        parts = [x.strip() for x in s.split(",")]
+        lengths = [_norm_len(x) + 2 for x in parts]
+        length = sum(lengths) - 2 - lengths[0]
+        i = 1
+        while length >= max_len:
+            length -= lengths[i]
+            i += 1
+        return ", ".join(parts[i:])
+
+    # nominatim's usage policy allows at most one request per second
+    delta = 1.0 - (time.time() - LAST_NOMINATIM)
+    if delta > 0.0:
+        time.sleep(delta)
+    LAST_NOMINATIM = time.time()
 
     # otherwise we get unicode mixed with latin which often exceeds
     # the 140character limit of twitter :(
     headers = {"Accept-Language": "en-US,en;q=0.8"}
     nominatim_url = (
-        "http://nominatim.openstreetmap.org/reverse?lat=%f&lon=%f&"
+        "https://nominatim.openstreetmap.org/reverse?lat=%f&lon=%f&"
         "addressdetails=0&format=json&zoom=6&extratags=0"
     )
-    info = json.loads(
-        requests.get(nominatim_url % (lat, lng), headers=headers).text
-    )
+    info = SESSION.get(
+        nominatim_url % (lat, lng), headers=headers, timeout=10
+    ).json()
     if "error" in info:
         return "Unknown location, do you recognise it?"
 
@@ -121,70 +210,101 @@ def get_address(lat, lng):
 
 
 def format_lat_lng(lat, lng):
-    s = ""
-    if lat < 0:
-        s += "%.1f°S" % abs(lat)
-    else:
-        s += "%.1f°N" % abs(lat)
-
-    s += " "
-
-    if lng < 0:
-        s += "%.1f°W" % abs(lng)
-    else:
-        s += "%.1f°E" % abs(lng)
+    return (
+        f"{abs(lat):.1f}°{'S' if lat < 0 else 'N'} "
+        f"{abs(lng):.1f}°{'W' if lng < 0 else 'E'}"
+    )
 
-    return s
 
+@lru_cache(maxsize=4096)
+def list_band2s(params):
+    """Names of all blue band (B02) JP2s of a MGRS tile, newest first
 
-@lru_cache(maxsize=256)
-def list_blobs(params):
+    Only the names are requested from GCS and kept in the cache, so many
+    tiles' listings fit in memory.
+    """
     while True:
         try:
-            return list(
-                BUCKET.list_blobs(prefix="tiles/%i/%s/%s/S2%s_MSIL1C" % params)
+            blobs = BUCKET.list_blobs(
+                prefix="tiles/%i/%s/%s/S2%s_MSIL1C" % params,
+                fields="items(name),nextPageToken",
+            )
+            return tuple(
+                sorted(
+                    (b.name for b in blobs if b.name.endswith("B02.jp2")),
+                    reverse=True,
+                )
             )
         except Exception:
             logging.info("Sleeping for 5s")
             time.sleep(5)
 
 
+def cloud_coverage(meta_name):
+    """Cloud coverage in percent read from a granule's metadata XML"""
+    meta_blob = BUCKET.blob(meta_name)
+    try:
+        data = meta_blob.download_as_string()
+        # stream through the document instead of building the whole tree,
+        # stopping as soon as we reach the cloud coverage
+        for _, elem in ET.iterparse(io.BytesIO(data)):
+            if elem.tag == "Cloud_Coverage_Assessment":
+                return float(elem.text)
+            elem.clear()
+    except Exception:
+        logging.info("Error parsing metadata XML. Sleep 2s.")
+        time.sleep(2)
+        return None
+
+    logging.info("No cloud coverage in metadata XML.")
+    return None
+
+
 def pick_date(area=(32, "T", "MT"), satellite="A", skip=0):
     params = area + (satellite,)
-    blobs = list_blobs(params)
-    if not blobs:
+    band2s = list_band2s(params)
+    if not band2s:
         logging.info("No blobs for MGRS: %s" % (area,))
         return None
 
-    band2s = [b for b in blobs if b.name.endswith("B02.jp2")]
-    # go up a few levels to find the meta data XML file
-    cloud_meta = [
-        "/".join(c.name.split("/")[:-4] + ["MTD_MSIL1C.xml"]) for c in band2s
-    ]
-
+    # fetch the metadata of a batch of dates at a time, enough to fullfill
+    # the skip request if none of them are cloudy
+    batch_size = skip + 8
     cloud_free = []
-    for band, cloud in zip(reversed(band2s), reversed(cloud_meta)):
-        meta_blob = BUCKET.blob(cloud)
-        try:
-            xml = ET.fromstring(meta_blob.download_as_string())
-        except Exception:
-            logging.info("Error parsing metadata XML. Sleep 2s.")
-            time.sleep(2)
-            continue
+    for start in range(0, len(band2s), batch_size):
+        batch = band2s[start : start + batch_size]
+        # go up a few levels to find the meta data XML file
+        cloud_meta = [
+            "/".join(b.split("/")[:-4] + ["MTD_MSIL1C.xml"]) for b in batch
+        ]
+        cloud_covers = [
+            METADATA_POOL.submit(cloud_coverage, c) for c in cloud_meta
+        ]
+
+        for band, cloud, cloud_cover in zip(batch, cloud_meta, cloud_covers):
+            cloud_cover = cloud_cover.result()
+            if cloud_cover is None:
+                continue
+
+            if cloud_cover > 20 or (0.2 < cloud_cover < 1.):
+                logging.info("Skipping because of cloud coverage.")
+                continue
+
+            logging.info(
+                "Picked %s with cloud coverage of %.3f%%."
+                % (cloud.rsplit("/", 1)[0], cloud_cover)
+            )
 
-        cloud_cover = float(next(xml.iter("Cloud_Coverage_Assessment")).text)
-        if cloud_cover > 20 or (0.2 < cloud_cover < 1.):
-            logging.info("Skipping because of cloud coverage.")
-            continue
+            cloud_free.append(band.replace("_B02.jp2", "_B0%i.jp2"))
 
-        logging.info(
-            "Picked %s with cloud coverage of %.3f%%."
-            % (cloud.rsplit("/", 1)[0], cloud_cover)
-        )
+            # only go back far enough to be able to fullfill skip request
+            if len(cloud_free) > skip:
+                break
 
-        cloud_free.append(band.name.replace("_B02.jp2", "_B0%i.jp2"))
+        # the pool is shared, don't leave downloads we no longer need queued
+        for f in cloud_covers:
+            f.cancel()
 
-        # only go back far enough to be able to fullfill skip request
         if len(cloud_free) > skip:
             break
 
@@ -195,6 +315,110 @@ def pick_date(area=(32, "T", "MT"), satellite="A", skip=0):
     return cloud_free[min(len(cloud_free), skip)]
 
 
+def percentiles16(band, q):
+    """Percentiles `q` of the uint16 `band`, read off its histogram
+
+    Counting the occurrences of each of the 65536 values takes one pass
+    and avoids sorting a copy of the band like `np.percentile` does.
+    """
+    cdf = np.cumsum(np.bincount(band.ravel(), minlength=2 ** 16))
+    return np.searchsorted(cdf, np.asarray(q) / 100. * cdf[-1])
+
+
+def rescale_band(band, low, high, out=None):
+    """Stretch the uint16 `band` to uint8 so `low` to `high` spans 0 to 255
+
+    The stretch is evaluated once for every possible value into a lookup
+    table, the band is then mapped through it in a single pass. The result
+    is written to `out` if given.
+    """
+    lut = np.arange(2 ** 16, dtype=np.float32)
+    lut -= low
+    lut *= 65535. / max(high - low, 1)
+    np.clip(lut, 0, 65535, out=lut)
+    lut = (lut.astype(np.uint16) >> 8).astype(np.uint8)
+    return np.take(lut, band, out=out)
+
+
+@contextmanager
+def open_band(picked, band):
+    """Open `band` of the granule `picked` straight from the bucket
+
+    The JP2 is read over HTTP so GDAL only fetches the byte ranges that
+    are actually read instead of the whole file.
+    """
+    url = "/vsicurl/https://storage.googleapis.com/%s/%s" % (
+        bucket_name,
+        picked % band,
+    )
+    with rasterio.Env(**GDAL_ENV), rasterio.open(url) as src:
+        yield src
+
+
+def fetch_band(picked, band):
+    """Read the central window of `band` of the granule `picked`
+
+    Returns the band and its validity mask, the mask is `None` if the
+    file declares no nodata value.
+    """
+    window = Window(4392, 4392, 1098 * 2, 1098 * 2)
+    with open_band(picked, band) as src:
+        if src.nodata is None:
+            return src.read(1, window=window), None
+        return src.read(1, window=window), src.read_masks(1, window=window)
+
+
+def granule_lnglat(picked):
+    """Longitude and latitude of the centre of the granule `picked`"""
+    # all bands cover the same area, open band 2 whose header then stays in
+    # GDAL's cache for the read in `fetch_band`
+    with open_band(picked, 2) as src:
+        return src.lnglat()
+
+
+def search_granules(rng, skip, probes=PROBES):
+    """Generate random (MGRS, granule) pairs with a cloud free date
+
+    `probes` random tiles are searched at the same time, most tiles have
+    no suitable date so this finds one several times faster.
+    """
+    def _pick(mgrs):
+        return pick_date(area=mgrs, skip=skip)
+
+    with ThreadPoolExecutor(probes) as pool:
+        while True:
+            time.sleep(1.5)
+            tiles = [random_mgrs(rng) for _ in range(probes)]
+            logging.info("Trying MGRS: %s" % (tiles,))
+            for mgrs, picked in zip(tiles, pool.map(_pick, tiles)):
+                if picked is not None:
+                    yield mgrs, picked
+
+
+def find_granules(rng, skip, granules, stop):
+    """Put the pairs found by `search_granules` on the queue `granules`
+
+    Runs until the `stop` event is set. An exception raised while
+    searching is put on the queue for the consumer to re-raise.
+    """
+
+    def _put(item):
+        while not stop.is_set():
+            try:
+                granules.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    try:
+        for found in search_granules(rng, skip):
+            _put(found)
+            if stop.is_set():
+                return
+    except Exception as e:
+        _put(e)
+
+
 def sentinel2_bot(
     seed=None,
     post=True,
@@ -208,171 +432,195 @@ def sentinel2_bot(
     last_post = time.time() - period
 
     rng = random.Random(seed)
-    seed = rng.randint(1, 2 ** 64)
-
-    if mgrs is None:
-        mgrs_ = random_mgrs(seed=seed)
-    else:
-        mgrs_ = mgrs
+    mgrs_ = mgrs
+
+    # when looping search for the next granules in the background while
+    # the current one is being processed
+    stop = threading.Event()
+    if mgrs is None and loop:
+        granules = queue.Queue(maxsize=2)
+        threading.Thread(
+            target=find_granules,
+            args=(random.Random(rng.random()), skip, granules, stop),
+            daemon=True,
+        ).start()
+    elif mgrs is None:
+        searcher = search_granules(random.Random(rng.random()), skip)
+
+    if post:
+        twitter_api = twitter.Api(**twitter_credentials())
 
     forever = True
-    while forever:
-        time.sleep(1.5)
-        if mgrs is None:
-            picked = None
-            while picked is None:
-                time.sleep(1.5)
-                seed += 1
-                mgrs_ = random_mgrs(seed=seed)
-                logging.info("Trying MGRS: %s" % (mgrs_,))
+    try:
+        while forever:
+            time.sleep(1.5)
+            if mgrs is None and loop:
+                found = granules.get()
+                if isinstance(found, Exception):
+                    raise found
+                mgrs_, picked = found
+            elif mgrs is None:
+                mgrs_, picked = next(searcher)
+            else:
                 picked = pick_date(area=mgrs_, skip=skip)
-        else:
-            picked = pick_date(area=mgrs_, skip=skip)
-
-        logging.info("Picked MGRS: %s" % (mgrs_,))
-
-        bands = []
-        for band in (4, 3, 2):
-            blob = BUCKET.blob(picked % band)
-
-            with TemporaryDirectory() as d:
-                b3 = os.path.join(d, "b.jp2")
-                blob.download_to_filename(b3)
-                with rasterio.open(b3) as src:
-                    lng, lat = src.lnglat()
-                    logging.info("Coordinate of the tile: %f, %f" % (lat, lng))
-
-                    bands.append(
-                        src.read(window=Window(4392, 4392, 1098 * 2, 1098 * 2))
-                    )
-
-        address = get_address(lat, lng)
-        logging.info("Address: %s" % address)
-        if address.startswith("Unknown location") and rng.random() > 0.1:
-            logging.info("Skipping image because it is in an unknown location.")
-            continue
-
-        # normal window
-        rgb = np.stack([a.squeeze(0) for a in bands])
-
-        rgb = np.moveaxis(rgb, 0, -1)
-        logging.info("Image dimensions %s." % (rgb.shape,))
-
-        # count fraction of exactly black pixels, this happens with
-        # partial acquisitions
-        black = count_pixels(rgb)
-        print(black, rgb.shape[0], rgb.shape[1])
-        if black / (rgb.shape[0] * rgb.shape[1]) > 0.1:
-            logging.info("Skipping image because it is incomplete.")
-            continue
-
-        # There should be no need to do weird things, just stretch each
-        # band individually. This works! The fact that (deep) oceans end
-        # up looking basically black makes sense because of how water reflects
-        # or doesn't(!!) reflect normally incident light.
-        median_intensities = np.array([0., 0., 0])
-        for i in (0, 1, 2):
-            low, high = np.percentile(rgb[:, :, i], (1, 97))
-            rgb[:, :, i] = exposure.rescale_intensity(
-                rgb[:, :, i], in_range=(low, high)
-            )
-            median_intensities[i] = np.median(rgb[:, :, i])
-            logging.info('median intensity: %s', np.median(rgb[:, :, i]))
 
-        if np.alltrue(median_intensities < 10000):
-            for i in (0, 1, 2):
-                low, high = np.percentile(rgb[:, :, i], (1, 91))
-                rgb[:, :, i] = exposure.rescale_intensity(
-                    rgb[:, :, i], in_range=(low, high)
+            logging.info("Picked MGRS: %s" % (mgrs_,))
+
+            # decide on the location before reading any pixels, opening one
+            # band only fetches its header
+            lng, lat = granule_lnglat(picked)
+            logging.info("Coordinate of the tile: %f, %f" % (lat, lng))
+
+            # only bother nominatim when we are going to tweet the address
+            if post:
+                address = get_address(lat, lng)
+            else:
+                address = "<skipped>"
+            logging.info("Address: %s" % address)
+            if address.startswith("Unknown location") and rng.random() > 0.1:
+                logging.info(
+                    "Skipping image because it is in an unknown location."
                 )
-                median_intensities[i] = np.median(rgb[:, :, i])
-                logging.info('median intensity: %s', np.median(rgb[:, :, i]))
-
-        if exposure.is_low_contrast(rgb):
-            logging.info("Skipping image because it is low contrast")
-            continue
-
-        if False:
-            plt.hist(
-                rgb[:, :, 0].ravel(),
-                bins=256,
-                color="r",
-                range=(0, 2 ** 16),
-                histtype="step",
-                label="red",
-            )
-            plt.hist(
-                rgb[:, :, 1].ravel(),
-                bins=256,
-                color="g",
-                range=(0, 2 ** 16),
-                histtype="step",
-                label="green",
+                continue
+
+            with ThreadPoolExecutor(3) as pool:
+                fetches = [
+                    pool.submit(fetch_band, picked, band) for band in (4, 3, 2)
+                ]
+                bands, masks = zip(*[f.result() for f in fetches])
+
+            # normal window, the raw uint16 bands are kept as separate arrays
+            # and only the final 8bit image is interleaved
+            shape = bands[0].shape + (3,)
+            logging.info("Image dimensions %s." % (shape,))
+
+            # count fraction of pixels without data, this happens with
+            # partial acquisitions. Use GDAL's nodata masks when the files have
+            # them, otherwise count exactly black pixels
+            if any(mask is None for mask in masks):
+                black = count_pixels(bands)
+            else:
+                black = np.count_nonzero((masks[0] | masks[1] | masks[2]) == 0)
+            logging.info(
+                "Black/nodata pixels: %i of %i" % (black, shape[0] * shape[1])
             )
-            plt.hist(
-                rgb[:, :, 2].ravel(),
-                bins=256,
-                color="b",
-                range=(0, 2 ** 16),
-                histtype="step",
-                label="blue",
+            if black / (shape[0] * shape[1]) > 0.1:
+                logging.info("Skipping image because it is incomplete.")
+                continue
+
+            # There should be no need to do weird things, just stretch each
+            # band individually. This works! The fact that (deep) oceans
+            # end up looking basically black makes sense because of how water
+            # reflects or doesn't(!!) reflect normally incident light.
+            #
+            # Dark images, where every band's median is below 10000 after
+            # stretching to the 97th percentile, get stretched to the 91st
+            # percentile instead. The stretch is monotonic so the median and
+            # the new limits can be worked out from the raw percentiles and
+            # each band only needs rescaling once.
+            lows, medians, highs_dark, highs = np.array(
+                [percentiles16(band, (1, 50, 91, 97)) for band in bands]
+            ).T
+            median_intensities = (
+                (medians - lows) * 65535. / np.maximum(highs - lows, 1)
             )
-            plt.legend(loc="best")
-            plt.show()
-
-        os.makedirs(output, exist_ok=True)
-
-        fname = picked.split("/")[-1]
-        identifier, _ = fname.rsplit("_", 1)
-        fname = "%s/%s_rgb.jpg" % (output, identifier)
-        fname_small = "%s/%s_rgb_small.jpg" % (output, identifier)
-
-        io.imsave(fname, rgb, quality=90)
-        io.imsave(
-            fname_small,
-            transform.resize(rgb, (1098 * 2, 1098 * 2)),
-            quality=90,
-        )
-
-        date = identifier[7:-7]
-        day = date[-2:]
-        month = MONTHS[int(date[-4:-2])]
-        year = date[:4]
-
-        MSG = "{location} ({lat_lng}), {date}"
-        msg = MSG.format(
-            date="%s %s %s" % (day, month, year),
-            lat_lng=format_lat_lng(lat, lng),
-            location=get_address(lat, lng),
-        )
-        logging.info("Twitter message: %s" % msg)
-        delta = period - (time.time() - last_post)
-
-        if delta > 0.0:
-            logging.info("Sleeping for %is before posting." % delta)
-            time.sleep(delta)
-
-        if post:
-            twitter_api = twitter.Api(**twitter_credentials())
-            logging.info("Posting to twitter.")
-            twitter_api.PostUpdate(
-                msg,
-                media=[fname_small],
-                latitude=lat,
-                longitude=lng,
-                display_coordinates=True,
+            for i in (0, 1, 2):
+                logging.info('median intensity: %s', median_intensities[i])
+
+            if np.alltrue(median_intensities < 10000):
+                highs = highs_dark
+
+            # judge the contrast on a stretched subsample so that rejected
+            # images don't pay for stretching the whole thing
+            preview = np.dstack(
+                [
+                    rescale_band(band[::8, ::8], lows[i], highs[i])
+                    for i, band in enumerate(bands)
+                ]
             )
 
-        if clean_up:
-            logging.info("Removing image %s." % fname)
-            os.remove(fname)
-            logging.info("Removing image %s." % fname_small)
-            os.remove(fname_small)
+            if exposure.is_low_contrast(preview):
+                logging.info("Skipping image because it is low contrast")
+                continue
+
+            # from here on 8bit per channel is all we need, the stretch goes
+            # straight from the uint16 bands into an uint8 image
+            rgb = np.empty(shape, dtype=np.uint8)
+            for i, band in enumerate(bands):
+                rescale_band(band, lows[i], highs[i], out=rgb[:, :, i])
+
+            if False:
+                plt.hist(
+                    rgb[:, :, 0].ravel(),
+                    bins=256,
+                    color="r",
+                    range=(0, 2 ** 8),
+                    histtype="step",
+                    label="red",
+                )
+                plt.hist(
+                    rgb[:, :, 1].ravel(),
+                    bins=256,
+                    color="g",
+                    range=(0, 2 ** 8),
+                    histtype="step",
+                    label="green",
+                )
+                plt.hist(
+                    rgb[:, :, 2].ravel(),
+                    bins=256,
+                    color="b",
+                    range=(0, 2 ** 8),
+                    histtype="step",
+                    label="blue",
+                )
+                plt.legend(loc="best")
+                plt.show()
+
+            os.makedirs(output, exist_ok=True)
+
+            fname = picked.split("/")[-1]
+            identifier, _ = fname.rsplit("_", 1)
+            fname = "%s/%s_rgb.jpg" % (output, identifier)
+
+            # the window is read at the size we post, no resizing needed
+            Image.fromarray(rgb).save(fname, format="JPEG", quality=90)
+
+            # identifier looks like T32TMT_20170101T103432
+            year = identifier[7:11]
+            month = MONTHS[int(identifier[11:13])]
+            day = identifier[13:15]
+
+            location = format_lat_lng(lat, lng)
+            msg = f"{address} ({location}), {day} {month} {year}"
+            logging.info("Twitter message: %s" % msg)
+            delta = period - (time.time() - last_post)
+
+            if delta > 0.0:
+                logging.info("Sleeping for %is before posting." % delta)
+                time.sleep(delta)
+
+            if post:
+                logging.info("Posting to twitter.")
+                twitter_api.PostUpdate(
+                    msg,
+                    media=[fname],
+                    latitude=lat,
+                    longitude=lng,
+                    display_coordinates=True,
+                )
+
+            if clean_up:
+                logging.info("Removing image %s." % fname)
+                os.remove(fname)
 
-        if not loop:
-            forever = False
+            if not loop:
+                forever = False
 
-        last_post = time.time()
+            last_post = time.time()
+    finally:
+        # also stop the background searcher when leaving with an error
+        stop.set()
 
 
 if __name__ == "__main__":